@@ -1,19 +1,30 @@
 import os
+import copy
+import time
+import queue
 import smtplib
+import click
 from typing import Final
-from datetime import date
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.message import EmailMessage
+import datetime
 from dotenv import load_dotenv
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate, upgrade
 from sqlalchemy.engine.result import Result
-from flask import Flask, abort, render_template, redirect, url_for, flash
+from jinja2 import FileSystemBytecodeCache
+from flask import Flask, abort, render_template, stream_template, redirect, url_for, flash, request
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
+from flask_caching import Cache
 from flask_login import login_user, LoginManager, current_user, logout_user
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 from forms import CreatePostForm, RegisterForm, LoginForm, CommentForm, ContactForm
-from sqlalchemy import Integer, String, Text
-from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
+from sqlalchemy import Integer, String, Text, Date, Boolean, insert, func, false
+from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column, selectinload, joinedload, raiseload, load_only
 from flask_login import UserMixin
 
 load_dotenv()
@@ -24,12 +35,43 @@ SECRET_KEY: Final[str] = os.getenv('SECRET_KEY')
 FROM_EMAIL: Final[str] = os.getenv('FROM_EMAIL')
 PASSWORD: Final[str] = os.getenv('PASSWORD')
 TO_EMAIL: Final[str] = os.getenv('TO_EMAIL')
+SMTP_HOST: Final[str] = "smtp.gmail.com"
+REDIS_URL: Final[str] = os.getenv('REDIS_URL')
+# Vercel freezes a serverless function once its response is sent, so work left on a thread may never run there
+SEND_EMAIL_IN_BACKGROUND: Final[bool] = not os.getenv('VERCEL')
+JINJA_CACHE_DIR: Final[str | None] = os.getenv('JINJA_CACHE_DIR')
+
+HOME_CACHE_KEY: Final[str] = "view/home"
+POSTS_PER_PAGE: Final[int] = 20
+# Every commenter gets the same default avatar, so the link never changes
+GRAVATAR_LINK: Final[str] = "https://www.gravatar.com/avatar/?s=100&d=retro&r=g&f=False"
+
+# Each worker process owns its own pool, so size it to the threads serving requests in one worker
+DB_POOL_SIZE: Final[int] = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW: Final[int] = int(os.getenv('DB_MAX_OVERFLOW', 10))
+
+# Argon2 cost parameters, tune them per deployment to balance login CPU time against login traffic
+ARGON2_TIME_COST: Final[int] = int(os.getenv('ARGON2_TIME_COST', 2))
+ARGON2_MEMORY_COST: Final[int] = int(os.getenv('ARGON2_MEMORY_COST', 19456))
+ARGON2_PARALLELISM: Final[int] = int(os.getenv('ARGON2_PARALLELISM', 1))
 
 app: Flask = Flask(__name__)
 app.config['SECRET_KEY'] = SECRET_KEY
+# Share compiled templates between workers and restarts instead of re-parsing them in each one.
+# Without an explicit directory Jinja uses a private per-user one, never a shared predictable path in /tmp
+if JINJA_CACHE_DIR:
+    os.makedirs(JINJA_CACHE_DIR, mode=0o700, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+else:
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 ckeditor = CKEditor(app)
 Bootstrap5(app)
 
+# Fall back to an in-process cache when no Redis server is configured
+app.config['CACHE_TYPE'] = "RedisCache" if REDIS_URL else "SimpleCache"
+app.config['CACHE_REDIS_URL'] = REDIS_URL
+cache: Cache = Cache(app)
+
 # Configure Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -37,71 +79,183 @@ current_user: UserMixin
 
 class Base(DeclarativeBase):
     __abstract__ = True
-db: SQLAlchemy = SQLAlchemy()
+# Objects are done with once their request commits, so don't expire them and reload on the next access
+db: SQLAlchemy = SQLAlchemy(session_options={"expire_on_commit": False})
 
 app.config['SQLALCHEMY_DATABASE_URI'] = DB
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+    "pool_timeout": 5
+}
 db.init_app(app)
+# Batch mode lets Alembic alter columns on SQLite, which has no ALTER COLUMN
+migrate: Migrate = Migrate(app, db, directory=os.path.join(app.root_path, "migrations"), render_as_batch=True)
 
 class BlogPost(db.Model):
     __tablename__ = "blog_posts"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
-    author = relationship("User", back_populates="posts")
+    author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"), index=True)
+    author = relationship("User", back_populates="posts", lazy="select")
     title: Mapped[str] = mapped_column(String(250), unique=True, nullable=False)
     subtitle: Mapped[str] = mapped_column(String(250), nullable=False)
-    date: Mapped[str] = mapped_column(String(250), nullable=False)
+    date: Mapped[datetime.date] = mapped_column(Date, nullable=False, server_default=func.current_date())
     body: Mapped[str] = mapped_column(Text, nullable=False)
     img_url: Mapped[str] = mapped_column(String(250), nullable=False)
-    comments = relationship("Comment", back_populates="parent_post", cascade="all, delete-orphan")
+    comments = relationship("Comment", back_populates="parent_post", cascade="all, delete-orphan", lazy="select")
 
 class User(UserMixin, db.Model):
     __tablename__ = "users"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    email: Mapped[str] = mapped_column(String(100), unique=True)
+    email: Mapped[str] = mapped_column(String(100), unique=True, index=True, nullable=False)
     password: Mapped[str] = mapped_column(String(100))
     name: Mapped[str] = mapped_column(String(100))
-    posts = relationship("BlogPost", back_populates="author")
-    comments = relationship("Comment", back_populates="comment_author")
+    is_admin: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false(), nullable=False)
+    posts = relationship("BlogPost", back_populates="author", lazy="select")
+    comments = relationship("Comment", back_populates="comment_author", lazy="select")
 
 class Comment(db.Model):
     __tablename__ = "comments"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     text: Mapped[str] = mapped_column(Text, nullable=False)
     author_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("users.id"))
-    comment_author = relationship("User", back_populates="comments")
-    post_id: Mapped[str] = mapped_column(Integer, db.ForeignKey("blog_posts.id"))
-    parent_post = relationship("BlogPost", back_populates="comments")
+    comment_author = relationship("User", back_populates="comments", lazy="select")
+    post_id: Mapped[str] = mapped_column(Integer, db.ForeignKey("blog_posts.id"), index=True)
+    parent_post = relationship("BlogPost", back_populates="comments", lazy="select")
+
+# Cache the logged-in user briefly so most requests don't need a query just to authenticate
+@cache.memoize(timeout=30)
+def get_session_user(user_id: int) -> User | None:
+    result: Result = db.session.execute(
+        db.select(User).options(load_only(User.id, User.email, User.name, User.is_admin)).where(User.id == user_id)
+    )
+    user: User | None = result.scalar()
+    if user:
+        # Detach it so the cached copy doesn't belong to any one request's session
+        db.session.expunge(user)
+    return user
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.get_or_404(User, user_id)
+    return get_session_user(int(user_id))
+
+def strict_loading() -> list:
+    # In debug/testing any relationship not explicitly eager-loaded raises instead of lazy loading
+    return [raiseload("*")] if app.debug or app.testing else []
 
-def gravatar_url(size=100, rating='g', default='retro', force_default=False):
-    return f"https://www.gravatar.com/avatar/?s={size}&d={default}&r={rating}&f={force_default}"
+# Keeps authenticated SMTP connections warm so each message doesn't pay for a new TLS handshake and login
+class SMTPPool:
+    def __init__(self, host: str, max_size: int = 2, idle_timeout: int = 100):
+        self.host = host
+        self.idle_timeout = idle_timeout
+        self._idle: queue.Queue = queue.Queue(maxsize=max_size)
 
-def send_email(message: str) -> None:
-     with smtplib.SMTP("smtp.gmail.com") as connection:
+    def connect(self) -> smtplib.SMTP:
+        connection = smtplib.SMTP(self.host)
         connection.starttls()
         connection.login(FROM_EMAIL, PASSWORD)
-        connection.sendmail(from_addr=FROM_EMAIL, to_addrs=TO_EMAIL, msg=message)
-        connection.quit()
-
-def construct_msg(name: str, email: str, phone_number: str, msg: str) -> str:
-    message: str = f"""Subject: Blog Website Contact \nFrom: noreply <{FROM_EMAIL}> \n\n
-                        You got a contact message \n
-                        From: {name} \n
-                        email: {email} \n
-                        phone number: {phone_number} \n
-                        message: {msg}"""
+        return connection
+
+    def get(self) -> smtplib.SMTP:
+        while True:
+            try:
+                connection, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            # Drop connections the server has most likely timed out, and check the rest are still alive
+            if time.monotonic() - last_used < self.idle_timeout:
+                try:
+                    if connection.noop()[0] == 250:
+                        return connection
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self.close(connection)
+
+    def put(self, connection: smtplib.SMTP) -> None:
+        try:
+            self._idle.put_nowait((connection, time.monotonic()))
+        except queue.Full:
+            self.close(connection)
+
+    @staticmethod
+    def close(connection: smtplib.SMTP) -> None:
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+smtp_pool: SMTPPool = SMTPPool(SMTP_HOST)
+# Sends contact emails off the request thread so the response doesn't wait on Gmail
+email_executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=2)
+
+def send_email(message: EmailMessage) -> None:
+    connection = smtp_pool.get()
+    try:
+        try:
+            connection.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped the connection since the health check, retry once on a fresh one
+            connection = smtp_pool.connect()
+            connection.send_message(message)
+    except Exception:
+        smtp_pool.close(connection)
+        raise
+    smtp_pool.put(connection)
+
+def log_email_failure(future: Future) -> None:
+    if future.exception() is not None:
+        app.logger.error("Failed to send contact email", exc_info=future.exception())
+
+# The headers are the same for every contact message, only the body changes
+EMAIL_TEMPLATE: Final[EmailMessage] = EmailMessage()
+EMAIL_TEMPLATE["Subject"] = "Blog Website Contact"
+EMAIL_TEMPLATE["From"] = f"noreply <{FROM_EMAIL}>"
+EMAIL_TEMPLATE["To"] = TO_EMAIL
+
+def construct_msg(name: str, email: str, phone_number: str, msg: str) -> EmailMessage:
+    # Deep copy, a shallow copy would share the header list with the template
+    message: EmailMessage = copy.deepcopy(EMAIL_TEMPLATE)
+    message.set_content(
+        "You got a contact message\n\n"
+        f"From: {name}\n"
+        f"Email: {email}\n"
+        f"Phone number: {phone_number}\n"
+        f"Message: {msg}\n"
+    )
     return message
 
 
+password_hasher: PasswordHasher = PasswordHasher(
+    time_cost=ARGON2_TIME_COST,
+    memory_cost=ARGON2_MEMORY_COST,
+    parallelism=ARGON2_PARALLELISM
+)
+
+def check_password(user: User, password: str) -> bool:
+    if user.password.startswith("$argon2"):
+        try:
+            password_hasher.verify(user.password, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if not password_hasher.check_needs_rehash(user.password):
+            return True
+    # Old pbkdf2:sha256 hashes from before the switch to argon2
+    elif not check_password_hash(user.password, password):
+        return False
+    # The password is correct, upgrade the stored hash to the current algorithm and parameters
+    user.password = password_hasher.hash(password)
+    db.session.commit()
+    return True
+
+
 # Create an admin-only decorator
 def admin_only(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # If id is not 1 then return abort with 403 error
-        if current_user.id != 1:
+        # Anonymous users never have an id, so check that first
+        if not current_user.is_authenticated or not current_user.is_admin:
             return abort(403)
         # Otherwise continue with the route function
         return f(*args, **kwargs)
@@ -109,6 +263,19 @@ def admin_only(f):
     return decorated_function
 
 
+# Grant admin rights from the command line, e.g. flask --app app make-admin you@example.com
+@app.cli.command("make-admin")
+@click.argument("email")
+def make_admin(email: str) -> None:
+    user: User | None = db.session.scalar(db.select(User).where(User.email == email))
+    if not user:
+        raise click.ClickException(f"No user with the email {email}")
+    user.is_admin = True
+    db.session.commit()
+    cache.delete_memoized(get_session_user, user.id)
+    click.echo(f"{user.name} is now an admin")
+
+
 # Register new users into the User database
 @app.route('/register', methods=["GET", "POST"])
 def register():
@@ -116,18 +283,13 @@ def register():
     if form.validate_on_submit():
 
         # Check if user email is already present in the database.
-        result = db.session.execute(db.select(User).where(User.email == form.email.data))
-        user = result.scalar()
-        if user:
+        user_exists = db.session.scalar(db.select(User.id).where(User.email == form.email.data).limit(1))
+        if user_exists:
             # User already exists
             flash("You've already signed up with that email, log in instead!")
             return redirect(url_for('login'))
 
-        hash_and_salted_password = generate_password_hash(
-            form.password.data,
-            method='pbkdf2:sha256',
-            salt_length=8
-        )
+        hash_and_salted_password = password_hasher.hash(form.password.data)
         new_user = User(
             email=form.email.data,
             name=form.name.data,
@@ -145,7 +307,10 @@ def login():
     form: LoginForm = LoginForm()
     if form.validate_on_submit():
         password: str = form.password.data
-        result: Result = db.session.execute(db.select(User).where(User.email == form.email.data))
+        # Only the columns needed to check the password and log the user in
+        result: Result = db.session.execute(
+            db.select(User).options(load_only(User.id, User.password)).where(User.email == form.email.data)
+        )
         # Note, email in db is unique so will only have one result.
         user: User = result.scalar()
         # Email doesn't exist
@@ -153,7 +318,7 @@ def login():
             flash("That email does not exist, please try again.")
             return redirect(url_for('login'))
         # Password incorrect
-        elif not check_password_hash(user.password, password):
+        elif not check_password(user, password):
             flash('Password incorrect, please try again.')
             return redirect(url_for('login'))
         else:
@@ -170,16 +335,34 @@ def logout():
 
 
 @app.route('/')
+# Only the first page is cached, the cache key doesn't include the query string
+@cache.cached(timeout=60, key_prefix=HOME_CACHE_KEY, unless=lambda: current_user.is_authenticated or "after" in request.args)
 def get_all_posts():
-    result = db.session.execute(db.select(BlogPost))
+    after: int | None = request.args.get("after", type=int)
+    # Keyset pagination, newest first, one extra row to find out if there is an older page
+    stmt = db.select(BlogPost).order_by(BlogPost.id.desc()).limit(POSTS_PER_PAGE + 1)
+    if after is not None:
+        stmt = stmt.where(BlogPost.id < after)
+    # Load every author in one extra query instead of one per post
+    result = db.session.execute(stmt.options(selectinload(BlogPost.author), *strict_loading()))
     posts = result.scalars().all()
-    return render_template("index.html", all_posts=posts, current_user=current_user)
+    older_posts_after: int | None = posts[POSTS_PER_PAGE - 1].id if len(posts) > POSTS_PER_PAGE else None
+    return render_template("index.html", all_posts=posts[:POSTS_PER_PAGE], older_posts_after=older_posts_after, current_user=current_user)
 
 
 # Add a POST method to be able to post comments
 @app.route("/post/<int:post_id>", methods=["GET", "POST"])
 def show_post(post_id):
-    requested_post = db.get_or_404(BlogPost, post_id)
+    # Load the post author, its comments and their authors up front to avoid N+1 queries
+    requested_post = db.one_or_404(
+        db.select(BlogPost)
+        .where(BlogPost.id == post_id)
+        .options(
+            joinedload(BlogPost.author),
+            selectinload(BlogPost.comments).joinedload(Comment.comment_author),
+            *strict_loading()
+        )
+    )
     # Add the CommentForm to the route
     comment_form: CommentForm = CommentForm()
     # Only allow logged-in users to comment on posts
@@ -188,15 +371,16 @@ def show_post(post_id):
             flash("You need to login or register to comment.")
             return redirect(url_for("login"))
 
-        new_comment = Comment(
+        # Insert the row directly, the page is reloaded below so the ORM objects don't need updating
+        db.session.execute(insert(Comment).values(
             text=comment_form.comment_text.data,
-            comment_author=current_user,
-            parent_post=requested_post
-        )
-        db.session.add(new_comment)
+            author_id=current_user.id,
+            post_id=requested_post.id
+        ))
         db.session.commit()
-    gravatar = gravatar_url()
-    return render_template("post.html", post=requested_post, current_user=current_user, form=comment_form, gravatar_link=gravatar)
+        # Reload the page so the committed post is fetched again with its eager-load options
+        return redirect(url_for("show_post", post_id=post_id))
+    return stream_template("post.html", post=requested_post, current_user=current_user, form=comment_form, gravatar_link=GRAVATAR_LINK)
 
 
 # Use a decorator so only an admin user can create new posts
@@ -205,38 +389,34 @@ def show_post(post_id):
 def add_new_post():
     form: CreatePostForm = CreatePostForm()
     if form.validate_on_submit():
-        new_post: BlogPost = BlogPost(
+        db.session.execute(insert(BlogPost).values(
             title=form.title.data,
             subtitle=form.subtitle.data,
             body=form.body.data,
             img_url=form.img_url.data,
-            author=current_user,
-            date=date.today().strftime("%B %d, %Y")
-        )
-        db.session.add(new_post)
+            author_id=current_user.id
+        ))
         db.session.commit()
+        cache.delete(HOME_CACHE_KEY)
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form, current_user=current_user)
 
 
 # Use a decorator so only an admin user can edit a post 
 @app.route("/edit-post/<int:post_id>", methods=["GET", "POST"])
+@admin_only
 def edit_post(post_id):
     post = db.get_or_404(BlogPost, post_id)
-    edit_form: CreatePostForm = CreatePostForm(
-        title=post.title,
-        subtitle=post.subtitle,
-        img_url=post.img_url,
-        author=post.author,
-        body=post.body
-    )
+    # Only pre-fill the form from the post when showing it, a submitted form already carries the data
+    edit_form: CreatePostForm = CreatePostForm() if request.method == "POST" else CreatePostForm(obj=post)
     if edit_form.validate_on_submit():
         post.title = edit_form.title.data
         post.subtitle = edit_form.subtitle.data
         post.img_url = edit_form.img_url.data
-        post.author = current_user
+        post.author_id = current_user.id
         post.body = edit_form.body.data
         db.session.commit()
+        cache.delete(HOME_CACHE_KEY)
         return redirect(url_for("show_post", post_id=post.id))
     return render_template("make-post.html", form=edit_form, is_edit=True, current_user=current_user)
 
@@ -248,6 +428,7 @@ def delete_post(post_id):
     post_to_delete: BlogPost = db.get_or_404(BlogPost, post_id)
     db.session.delete(post_to_delete)
     db.session.commit()
+    cache.delete(HOME_CACHE_KEY)
     return redirect(url_for('get_all_posts'))
 
 
@@ -265,13 +446,22 @@ def contact():
         phone: str = form.phone_number.data
         message: str = form.message.data
         
-        formatted_message: str = construct_msg(name=name, email=email, phone_number=phone, msg=message)
-
-        try:
-            send_email(formatted_message)
-            flash("Your message has been sent successfully!", "success")
-        except:
-            flash("An unexpected error occurred. Please try again later", "danger")
+        formatted_message: EmailMessage = construct_msg(name=name, email=email, phone_number=phone, msg=message)
+
+        if SEND_EMAIL_IN_BACKGROUND:
+            try:
+                email_executor.submit(send_email, formatted_message).add_done_callback(log_email_failure)
+                flash("Your message has been queued and will be sent shortly!", "success")
+            except RuntimeError:
+                # The executor has been shut down
+                flash("An unexpected error occurred. Please try again later", "danger")
+        else:
+            try:
+                send_email(formatted_message)
+                flash("Your message has been sent successfully!", "success")
+            except Exception:
+                app.logger.exception("Failed to send contact email")
+                flash("An unexpected error occurred. Please try again later", "danger")
 
         # Redirect or render a success message after processing the form
         return redirect(url_for("contact"))
@@ -280,5 +470,5 @@ def contact():
 
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
+        upgrade()
     app.run(debug=True) 
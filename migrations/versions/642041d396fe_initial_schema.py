@@ -0,0 +1,57 @@
+"""initial schema
+
+Revision ID: 642041d396fe
+Revises: 
+Create Date: 2026-10-15 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '642041d396fe'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases set up with db.create_all() before migrations existed already have these tables
+    if sa.inspect(op.get_bind()).has_table('users'):
+        return
+    op.create_table('users',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('email', sa.String(length=100), nullable=False),
+    sa.Column('password', sa.String(length=100), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email')
+    )
+    op.create_table('blog_posts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(length=250), nullable=False),
+    sa.Column('subtitle', sa.String(length=250), nullable=False),
+    sa.Column('date', sa.String(length=250), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('img_url', sa.String(length=250), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('title')
+    )
+    op.create_table('comments',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['users.id'], ),
+    sa.ForeignKeyConstraint(['post_id'], ['blog_posts.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('comments')
+    op.drop_table('blog_posts')
+    op.drop_table('users')
@@ -0,0 +1,117 @@
+"""upgrade blog schema
+
+Store post dates as DATE instead of preformatted strings, and index the
+columns used by login, register and the post/comment eager loads, and
+replace the hard-coded "user 1 is the admin" rule with an is_admin flag.
+
+Revision ID: 8eafd6b1cb23
+Revises: 642041d396fe
+Create Date: 2026-10-15 10:05:00.000000
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8eafd6b1cb23'
+down_revision = '642041d396fe'
+branch_labels = None
+depends_on = None
+
+# Format add_new_post used to store dates in, e.g. "May 12, 2024"
+OLD_DATE_FORMAT = "%B %d, %Y"
+
+
+def parse_date(value: str) -> datetime.date:
+    try:
+        return datetime.datetime.strptime(value.strip(), OLD_DATE_FORMAT).date()
+    except ValueError:
+        return datetime.date.fromisoformat(value.strip())
+
+
+def upgrade():
+    connection = op.get_bind()
+
+    # Copy each formatted date into a new DATE column, then swap it in for the old one
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.add_column(sa.Column('published', sa.Date(), nullable=True))
+    blog_posts = sa.table('blog_posts',
+        sa.column('id', sa.Integer()),
+        sa.column('date', sa.String()),
+        sa.column('published', sa.Date())
+    )
+    for post_id, value in connection.execute(sa.select(blog_posts.c.id, blog_posts.c.date)).all():
+        connection.execute(
+            blog_posts.update().where(blog_posts.c.id == post_id).values(published=parse_date(value))
+        )
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.drop_column('date')
+        batch_op.alter_column('published',
+            new_column_name='date',
+            existing_type=sa.Date(),
+            nullable=False,
+            server_default=sa.text('CURRENT_DATE')
+        )
+
+    # A unique index replaces the plain UNIQUE constraint on users.email. SQLite leaves that constraint
+    # unnamed, so it can only be dropped where the database has given it a name
+    email_constraint = next(
+        (constraint['name'] for constraint in sa.inspect(connection).get_unique_constraints('users')
+         if constraint['column_names'] == ['email'] and constraint['name']),
+        None
+    )
+    with op.batch_alter_table('users') as batch_op:
+        if email_constraint:
+            batch_op.drop_constraint(email_constraint, type_='unique')
+        batch_op.alter_column('email', existing_type=sa.String(length=100), nullable=False)
+        batch_op.create_index('ix_users_email', ['email'], unique=True)
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.create_index('ix_blog_posts_author_id', ['author_id'], unique=False)
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.create_index('ix_comments_post_id', ['post_id'], unique=False)
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('is_admin', sa.Boolean(), server_default=sa.false(), nullable=False))
+    # User 1 was the admin before the flag existed
+    users = sa.table('users', sa.column('id', sa.Integer()), sa.column('is_admin', sa.Boolean()))
+    connection.execute(users.update().where(users.c.id == 1).values(is_admin=True))
+
+
+def downgrade():
+    connection = op.get_bind()
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('is_admin')
+
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.drop_index('ix_comments_post_id')
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.drop_index('ix_blog_posts_author_id')
+    with op.batch_alter_table('users') as batch_op:
+        # email was already NOT NULL in the original schema, so only the index is undone
+        batch_op.drop_index('ix_users_email')
+    if not any(constraint['column_names'] == ['email'] for constraint in sa.inspect(connection).get_unique_constraints('users')):
+        with op.batch_alter_table('users') as batch_op:
+            batch_op.create_unique_constraint('users_email_key', ['email'])
+
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.add_column(sa.Column('formatted_date', sa.String(length=250), nullable=True))
+    blog_posts = sa.table('blog_posts',
+        sa.column('id', sa.Integer()),
+        sa.column('date', sa.Date()),
+        sa.column('formatted_date', sa.String())
+    )
+    for post_id, value in connection.execute(sa.select(blog_posts.c.id, blog_posts.c.date)).all():
+        connection.execute(
+            blog_posts.update().where(blog_posts.c.id == post_id).values(formatted_date=value.strftime(OLD_DATE_FORMAT))
+        )
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.drop_column('date')
+        batch_op.alter_column('formatted_date',
+            new_column_name='date',
+            existing_type=sa.String(length=250),
+            nullable=False
+        )
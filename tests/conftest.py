@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+# app.py reads its settings from the environment at import time
+DB_FILE: str = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["DB"] = f"sqlite:///{DB_FILE}"
+os.environ.setdefault("SECRET_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app, db, cache
+
+# More queries than this on a read page usually means a relationship is being lazy loaded in a loop
+MAX_QUERIES_PER_PAGE: int = 3
+
+
+@pytest.fixture
+def app():
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        db.create_all()
+        cache.clear()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def count_queries(app):
+    # Collects every statement sent to the database inside the with block
+    @contextmanager
+    def counter():
+        statements: list[str] = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+    return counter
+
+
+@pytest.fixture
+def log_in(client):
+    # Logs the test client in as the given user without going through the login form
+    def log_in_as(user_id: int) -> None:
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user_id)
+            session["_fresh"] = True
+
+    return log_in_as
@@ -0,0 +1,44 @@
+from app import app, db, User
+
+
+def add_user(email: str, is_admin: bool = False) -> User:
+    user = User(email=email, name=email.split("@")[0], password="x", is_admin=is_admin)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def test_anonymous_user_cannot_create_posts(client):
+    assert client.get("/new-post").status_code == 403
+
+
+def test_non_admin_cannot_create_posts(client, log_in):
+    log_in(add_user("reader@example.com").id)
+
+    assert client.get("/new-post").status_code == 403
+
+
+def test_new_users_are_not_admins(client):
+    add_user("admin@example.com", is_admin=True)
+
+    client.post("/register", data={"email": "first@example.com", "password": "secret", "name": "First"})
+
+    assert db.session.scalar(db.select(User.is_admin).where(User.email == "first@example.com")) is False
+
+
+def test_make_admin_command(client, log_in):
+    user: User = add_user("reader@example.com")
+
+    result = app.test_cli_runner().invoke(args=["make-admin", "reader@example.com"])
+
+    assert result.exit_code == 0
+    assert db.session.scalar(db.select(User.is_admin).where(User.id == user.id)) is True
+    log_in(user.id)
+    assert client.get("/new-post").status_code == 200
+
+
+def test_make_admin_command_unknown_email(client):
+    result = app.test_cli_runner().invoke(args=["make-admin", "nobody@example.com"])
+
+    assert result.exit_code != 0
+    assert "No user with the email nobody@example.com" in result.output
@@ -0,0 +1,34 @@
+from werkzeug.security import generate_password_hash
+
+from app import db, User
+
+
+def test_login_upgrades_legacy_pbkdf2_hash(client):
+    db.session.add(User(
+        email="legacy@example.com",
+        name="Legacy",
+        password=generate_password_hash("secret", method="pbkdf2:sha256", salt_length=8)
+    ))
+    db.session.commit()
+
+    response = client.post("/login", data={"email": "legacy@example.com", "password": "secret"})
+
+    assert response.status_code == 302
+    assert response.location == "/"
+    password: str = db.session.scalar(db.select(User.password).where(User.email == "legacy@example.com"))
+    assert password.startswith("$argon2")
+
+
+def test_login_rejects_wrong_password_for_legacy_hash(client):
+    db.session.add(User(
+        email="legacy@example.com",
+        name="Legacy",
+        password=generate_password_hash("secret", method="pbkdf2:sha256", salt_length=8)
+    ))
+    db.session.commit()
+
+    response = client.post("/login", data={"email": "legacy@example.com", "password": "wrong"})
+
+    assert response.location == "/login"
+    password: str = db.session.scalar(db.select(User.password).where(User.email == "legacy@example.com"))
+    assert password.startswith("pbkdf2:sha256")
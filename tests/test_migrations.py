@@ -0,0 +1,64 @@
+import datetime
+
+import pytest
+import sqlalchemy as sa
+from flask_migrate import upgrade
+
+from app import db, BlogPost, User
+
+INITIAL_REVISION: str = "642041d396fe"
+
+
+@pytest.fixture
+def baseline_db(app):
+    # Start from the schema db.create_all() built before migrations were added
+    db.drop_all()
+    upgrade(revision=INITIAL_REVISION)
+    yield
+    db.session.remove()
+    db.drop_all()
+    with db.engine.begin() as connection:
+        connection.execute(sa.text("DROP TABLE IF EXISTS alembic_version"))
+
+
+def test_upgrade_converts_formatted_post_dates(baseline_db):
+    with db.engine.begin() as connection:
+        connection.execute(sa.text(
+            "INSERT INTO users (id, email, password, name) VALUES (1, 'admin@example.com', 'x', 'Admin')"
+        ))
+        connection.execute(sa.text(
+            "INSERT INTO blog_posts (id, author_id, title, subtitle, date, body, img_url) "
+            "VALUES (1, 1, 'Title', 'Subtitle', 'May 12, 2024', 'Body', 'https://example.com/a.jpg')"
+        ))
+
+    upgrade()
+
+    assert db.session.scalar(db.select(BlogPost.date).where(BlogPost.id == 1)) == datetime.date(2024, 5, 12)
+
+
+def test_upgrade_adds_lookup_indexes(baseline_db):
+    upgrade()
+
+    inspector = sa.inspect(db.engine)
+    assert any(index["name"] == "ix_users_email" and index["unique"] for index in inspector.get_indexes("users"))
+    assert "ix_blog_posts_author_id" in [index["name"] for index in inspector.get_indexes("blog_posts")]
+    assert "ix_comments_post_id" in [index["name"] for index in inspector.get_indexes("comments")]
+
+
+def test_upgrade_keeps_user_1_as_admin(baseline_db, client):
+    with db.engine.begin() as connection:
+        connection.execute(sa.text(
+            "INSERT INTO users (id, email, password, name) VALUES "
+            "(1, 'admin@example.com', 'x', 'Admin'), (2, 'reader@example.com', 'x', 'Reader')"
+        ))
+        connection.execute(sa.text(
+            "INSERT INTO blog_posts (id, author_id, title, subtitle, date, body, img_url) "
+            "VALUES (1, 1, 'Title', 'Subtitle', 'May 12, 2024', 'Body', 'https://example.com/a.jpg')"
+        ))
+
+    upgrade()
+
+    assert db.session.scalars(db.select(User.id).where(User.is_admin)).all() == [1]
+    response = client.get("/")
+    assert response.status_code == 200
+    assert b"May 12, 2024" in response.data
@@ -0,0 +1,50 @@
+from sqlalchemy import insert
+
+from app import db, User, BlogPost, Comment
+from conftest import MAX_QUERIES_PER_PAGE
+
+
+def add_posts_with_comments(count: int = 3) -> None:
+    # A different author for every post and comment, so lazy loading would cost one query each
+    for number in range(1, count + 1):
+        db.session.execute(insert(User).values(id=number, email=f"user{number}@example.com", password="x", name=f"User {number}"))
+        db.session.execute(insert(BlogPost).values(
+            id=number, author_id=number, title=f"Post {number}", subtitle="Subtitle", body="Body", img_url="https://example.com/a.jpg"
+        ))
+    for number in range(1, count + 1):
+        db.session.execute(insert(Comment).values(text=f"Comment {number}", author_id=number, post_id=1))
+    db.session.commit()
+    db.session.expunge_all()
+
+
+def test_home_page_query_count(client, count_queries):
+    add_posts_with_comments()
+
+    with count_queries() as queries:
+        response = client.get("/")
+
+    assert response.status_code == 200
+    assert len(queries) <= MAX_QUERIES_PER_PAGE
+
+
+def test_home_page_query_count_logged_in(client, count_queries, log_in):
+    add_posts_with_comments()
+    log_in(2)
+
+    with count_queries() as queries:
+        response = client.get("/")
+
+    assert response.status_code == 200
+    assert len(queries) <= MAX_QUERIES_PER_PAGE
+
+
+def test_post_page_query_count(client, count_queries):
+    add_posts_with_comments()
+
+    with count_queries() as queries:
+        response = client.get("/post/1")
+        body: bytes = response.get_data()
+
+    assert response.status_code == 200
+    assert b"User 3" in body
+    assert len(queries) <= MAX_QUERIES_PER_PAGE